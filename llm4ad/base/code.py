@@ -50,6 +50,7 @@ from __future__ import annotations
 import ast
 import copy
 import dataclasses
+import functools
 from typing import Any, List, Callable
 
 
@@ -214,6 +215,20 @@ class _ProgramVisitor(ast.NodeVisitor):
         return Program(preface=self._preface, functions=self._functions)
 
 
+@functools.lru_cache(maxsize=4096)
+def _parse_program(program_str: str) -> Program:
+    """Parses the text to a Program instance. The result is cached, as the same text
+    (e.g., a program to be evaluated, or a function that appears in many prompts) is often parsed repeatedly.
+    Please note that the returned instance is shared, do not modify it.
+    """
+    # We assume that the program is composed of some preface (e.g. imports,
+    # classes, assignments, ...) followed by a sequence of functions.
+    tree = ast.parse(program_str)
+    visitor = _ProgramVisitor(program_str)
+    visitor.visit(tree)
+    return visitor.return_program()
+
+
 class TextFunctionProgramConverter:
     """Convert text to Program instance and Function instance,
     Convert Program instance to Function instance, and Function instance to Program instance.
@@ -224,12 +239,8 @@ class TextFunctionProgramConverter:
         """Returns Program object by parsing input text using Python AST.
         """
         try:
-            # We assume that the program is composed of some preface (e.g. imports,
-            # classes, assignments, ...) followed by a sequence of functions.
-            tree = ast.parse(program_str)
-            visitor = _ProgramVisitor(program_str)
-            visitor.visit(tree)
-            return visitor.return_program()
+            # copy the cached instance, as the caller may modify it
+            return copy.deepcopy(_parse_program(program_str))
         except:
             return None
 
@@ -20,6 +20,7 @@
 from __future__ import annotations
 
 import ast
+import asyncio
 import copy
 from abc import abstractmethod
 from typing import Any, List
@@ -56,6 +57,30 @@ class LLM:
         """
         return [self.draw_sample(p, *args, **kwargs) for p in prompts]
 
+    async def draw_samples_async(self, prompts: List[str | Any], *args, **kwargs) -> List[str]:
+        """Returns multiple predicted continuations of `prompt` without blocking the event loop.
+        By default, `self.draw_samples` is invoked in a separate thread.
+        Override this method if the LLM provides an async client.
+        """
+        return await asyncio.to_thread(self.draw_samples, prompts, *args, **kwargs)
+
+    def draw_samples_per_prompt(self, prompts: List[str | Any], n: int | List[int] = 1, *args, **kwargs) -> List[str]:
+        """Returns `n` predicted continuations of each prompt (or `n[i]` continuations of `prompts[i]`),
+        ordered by their prompts. By default, each prompt is repeated and sent through `self.draw_samples`.
+        Override this method if the LLM returns multiple continuations of a prompt in one request,
+        such as the 'n' parameter of the OpenAI API.
+        """
+        if isinstance(n, int):
+            n = [n] * len(prompts)
+        return self.draw_samples([p for p, num in zip(prompts, n) for _ in range(num)], *args, **kwargs)
+
+    async def draw_samples_per_prompt_async(self, prompts: List[str | Any], n: int | List[int] = 1, *args, **kwargs) -> List[str]:
+        """Returns `n` predicted continuations of each prompt (or `n[i]` continuations of `prompts[i]`),
+        ordered by their prompts, without blocking the event loop.
+        By default, `self.draw_samples_per_prompt` is invoked in a separate thread.
+        """
+        return await asyncio.to_thread(self.draw_samples_per_prompt, prompts, n, *args, **kwargs)
+
 
 class SampleTrimmer:
     def __init__(self, llm: LLM):
@@ -79,6 +104,33 @@ class SampleTrimmer:
             ret = [self.__class__.auto_trim(code) for code in ret]
         return ret
 
+    async def draw_samples_async(self, prompts: List[str | Any], *args, **kwargs) -> List[str]:
+        """Get samples based on the provided 'Sampler' instance without blocking the event loop.
+        If the inner sampler sets 'auto_trim' to True, trim anything before the function body.
+        """
+        ret = await self._llm.draw_samples_async(prompts, *args, **kwargs)
+        if self._llm.do_auto_trim:
+            ret = [self.__class__.auto_trim(code) for code in ret]
+        return ret
+
+    def draw_samples_per_prompt(self, prompts: List[str | Any], n: int | List[int] = 1, *args, **kwargs) -> List[str]:
+        """Get `n` samples of each prompt (or `n[i]` samples of `prompts[i]`) based on the provided 'Sampler' instance.
+        If the inner sampler sets 'auto_trim' to True, trim anything before the function body.
+        """
+        ret = self._llm.draw_samples_per_prompt(prompts, n, *args, **kwargs)
+        if self._llm.do_auto_trim:
+            ret = [self.__class__.auto_trim(code) for code in ret]
+        return ret
+
+    async def draw_samples_per_prompt_async(self, prompts: List[str | Any], n: int | List[int] = 1, *args, **kwargs) -> List[str]:
+        """Get `n` samples of each prompt (or `n[i]` samples of `prompts[i]`) based on the provided 'Sampler' instance
+        without blocking the event loop. If the inner sampler sets 'auto_trim' to True, trim anything before the function body.
+        """
+        ret = await self._llm.draw_samples_per_prompt_async(prompts, n, *args, **kwargs)
+        if self._llm.do_auto_trim:
+            ret = [self.__class__.auto_trim(code) for code in ret]
+        return ret
+
     @classmethod
     def _check_indent_if_code_completion(cls, generated_code: str) -> bool:
         """Judge if the content is generated through code completion model or instruct model.
@@ -147,10 +199,21 @@ class SampleTrimmer:
         Please note that the modified Function instance is not executable,
         as it lacks 'import ...' statements.
         """
+        _, function = cls.sample_to_program_and_function(generated_code, template_program)
+        return function
+
+    @classmethod
+    def sample_to_program_and_function(cls, generated_code: str, template_program: str | Program) \
+            -> tuple[Program, Function] | tuple[None, None]:
+        """Convert the generated content (with redundant component)
+        to a Program instance and a Function instance. If the convert fails, return (None, None).
+        The Function instance is a copy of the function in the Program instance,
+        so there is no need to convert the Program instance to a Function instance again.
+        """
         program = cls.sample_to_program(generated_code, template_program)
         if program is None:
-            return None
-        return TextFunctionProgramConverter.program_to_function(program)
+            return None, None
+        return program, copy.deepcopy(program.functions[0])
 
     @classmethod
     def sample_to_program(cls, generated_code: str, template_program: str | Program) -> Program | None:
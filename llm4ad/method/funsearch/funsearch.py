@@ -25,9 +25,11 @@
 
 from __future__ import annotations
 
+import asyncio
 import concurrent.futures
 import time
-from threading import Thread
+from collections import OrderedDict, deque
+from threading import Thread, Lock, Condition, Semaphore, Event
 import traceback
 from typing import Optional, Literal
 
@@ -35,8 +37,21 @@ from . import programs_database
 from .config import ProgramsDatabaseConfig
 from ...base import *
 from .profiler import FunSearchProfiler
+from .prompt_cache import SemanticPromptCache
 from ...tools.profiler import ProfilerBase
 
+# the evaluator of each evaluation worker process, which is created once by the initializer of the worker
+_WORKER_EVALUATOR: SecureEvaluator | None = None
+
+
+def _init_evaluation_worker(evaluation: Evaluation, debug_mode: bool, kwargs: dict):
+    global _WORKER_EVALUATOR
+    _WORKER_EVALUATOR = SecureEvaluator(evaluation, debug_mode=debug_mode, **kwargs)
+
+
+def _evaluate_in_worker(program_str: str):
+    return _WORKER_EVALUATOR.evaluate_program_record_time(program_str)
+
 
 class FunSearch:
     def __init__(self,
@@ -47,10 +62,14 @@ class FunSearch:
                  num_evaluators: int = 4,
                  samples_per_prompt: int = 4,
                  max_sample_nums: Optional[int] = 20,
+                 batch_prompts: int = 1,
                  *,
                  resume_mode: bool = False,
                  debug_mode: bool = False,
                  multi_thread_or_process_eval: Literal['thread', 'process'] = 'thread',
+                 eval_cache_size: int = 1024,
+                 prompt_cache_threshold: Optional[float] = None,
+                 async_sampling: bool = False,
                  **kwargs):
         """Function Search.
         Args:
@@ -59,9 +78,13 @@ class FunSearch:
             llm             : an instance of 'llm4ad.base.LLM', which provides the way to query LLM.
             evaluation      : an instance of 'llm4ad.base.Evaluator', which defines the way to calculate the score of a generated function.
             profiler        : an instance of 'llm4ad.method.funsearch.FunSearchProfiler'. If you do not want to use it, you can pass a 'None'.
-            max_sample_nums : terminate after evaluating max_sample_nums functions (no matter the function is valid or not).
+            max_sample_nums : terminate after drawing max_sample_nums samples (no matter the function is valid or not),
+                including the samples reused from the prompt cache (see 'prompt_cache_threshold').
             num_samplers    : number of independent Samplers in the experiment.
             num_evaluators  : number of independent program Evaluators in the experiment.
+            batch_prompts   : number of prompts each Sampler gets from the program database at a time. The samples of all these
+                prompts are drawn through a single 'draw_samples_per_prompt' call, so that an LLM which overrides 'draw_samples_per_prompt'
+                to serve a batch of prompts per request is queried once for the batch.
             resume_mode     : in resume_mode, funsearch will not evaluate the template_program, and will skip the init process. TODO: More detailed usage.
             debug_mode      : if set to True, we will print detailed information.
             multi_thread_or_process_eval: use 'concurrent.futures.ThreadPoolExecutor' or 'concurrent.futures.ProcessPoolExecutor' for the usage of
@@ -69,6 +92,19 @@ class FunSearch:
                 setting this parameter to 'process' will faster than 'thread'. However, I do not sure if this happens on all platform so I set the default to 'thread'.
                 Please note that there is one case that cannot utilize multi-core CPU: if you set 'safe_evaluate' argument in 'evaluator' to 'False',
                 and you set this argument to 'thread'.
+            eval_cache_size : the maximum number of (score, evaluate_time) records of evaluated programs kept in memory.
+                A sampled program that is identical to a cached one (ignoring comments, formatting, docstrings, and type annotations)
+                reuses the record instead of being evaluated again. Set to 0 to disable the cache. Please note that a sampled program
+                identical to a function in the program database always reuses the score of that function.
+            prompt_cache_threshold: if is not None, the sampled functions of each prompt are cached, and a later prompt
+                whose estimated Jaccard similarity to a cached prompt exceeds this threshold reuses the cached functions
+                instead of querying the LLM. The reused functions are still registered to the island of the later prompt.
+                Please note that the reused functions count against 'max_sample_nums' as if they were drawn from the LLM,
+                although they are replays that reuse their previous scores, and bring no new program to the database.
+            async_sampling  : if set to True, the Samplers are coroutines in a single event loop thread querying the LLM through
+                'LLM.draw_samples_per_prompt_async', instead of 'num_samplers' threads. As an event loop can host many more Samplers than threads,
+                a large 'num_samplers' is recommended, along with an LLM that overrides 'draw_samples_per_prompt_async' with an async client
+                (such as 'OpenAIAPI'). Otherwise, each request to the LLM occupies a thread of the event loop.
             **kwargs        : some args pass to 'llm4ad.base.SecureEvaluator'. Such as 'fork_proc'.
         """
         # arguments and keywords
@@ -77,6 +113,7 @@ class FunSearch:
         self._num_samplers = num_samplers
         self._num_evaluators = num_evaluators
         self._samples_per_prompt = samples_per_prompt
+        self._batch_prompts = batch_prompts
         self._debug_mode = debug_mode
         self._resume_mode = resume_mode
 
@@ -97,8 +134,21 @@ class FunSearch:
         self._evaluator = SecureEvaluator(evaluation, debug_mode=debug_mode, **kwargs)
         self._profiler = profiler
 
-        # statistics
+        # statistics, samples are reserved from the budget under the lock before they are drawn
         self._tot_sample_nums = 0
+        self._tot_sample_nums_lock = Lock()
+        # reserved samples that are not drawn yet, which are given back to the budget if drawing them fails
+        self._num_undrawn_samples = 0
+
+        # cache of evaluated programs: canonical hash of the function => (score, evaluate_time)
+        self._eval_cache_size = eval_cache_size
+        self._eval_cache: OrderedDict[bytes, tuple[float | None, float]] = OrderedDict()
+        self._eval_cache_lock = Lock()
+
+        # cache of sampled functions for near-duplicate prompts
+        self._prompt_cache = None
+        if prompt_cache_threshold is not None:
+            self._prompt_cache = SemanticPromptCache(threshold=prompt_cache_threshold)
 
         # multi-thread executor for evaluation
         assert multi_thread_or_process_eval in ['thread', 'process']
@@ -106,86 +156,326 @@ class FunSearch:
             self._evaluation_executor = concurrent.futures.ThreadPoolExecutor(
                 max_workers=self._num_evaluators
             )
+            self._evaluate_fn = self._evaluator.evaluate_program_record_time
+            self._submit_program_str = False
         else:
+            # each worker process creates its evaluator once, instead of receiving the evaluator with each task
             self._evaluation_executor = concurrent.futures.ProcessPoolExecutor(
-                max_workers=self._num_evaluators
+                max_workers=self._num_evaluators,
+                initializer=_init_evaluation_worker,
+                initargs=(evaluation, debug_mode, kwargs)
             )
+            self._evaluate_fn = _evaluate_in_worker
+            # only the source code crosses the process boundary, rather than the pickled Program instance
+            self._submit_program_str = True
+        # bound the number of programs waiting in or being evaluated by the executor,
+        # so that the task queue does not grow if sampling is faster than evaluation
+        self._eval_slots = Semaphore(self._num_evaluators * 2)
 
-        # threads for sampling
-        self._sampler_threads = [
-            Thread(target=self._sample_evaluate_register) for _ in range(self._num_samplers)
-        ]
+        # evaluations in flight: (future, function, canonical hash, island_id, sample_time), which are registered as soon as
+        # they finish by the register thread, so that the samplers can draw the next samples without waiting for the evaluation
+        self._in_flight: deque[tuple[concurrent.futures.Future, Function, bytes, int, float]] = deque()
+        self._in_flight_capacity = self._num_evaluators * 2
+        self._in_flight_cond = Condition()
+        self._sampling_finished = False
+
+        # set once the budget is exhausted or the run is interrupted, the samplers stop drawing samples then
+        self._stop = Event()
+
+        # threads for sampling, or a single thread running an event loop for all samplers in async mode
+        if async_sampling:
+            self._sampler_threads = [Thread(target=self._run_async_samplers)]
+        else:
+            self._sampler_threads = [
+                Thread(target=self._sample_evaluate_register) for _ in range(self._num_samplers)
+            ]
+        # thread for registering evaluated programs
+        self._register_thread = Thread(target=self._register_evaluated_programs)
 
         # pass parameters to profiler
         if profiler is not None:
             self._profiler.record_parameters(llm, evaluation, self)  # ZL: necessary
 
+    def _cached_or_submit(self, key: bytes, program: Program) -> concurrent.futures.Future:
+        """Returns a resolved future if the program has been evaluated before,
+        or a structurally identical function is in the program database,
+        otherwise submits the program to the evaluation executor.
+        """
+        with self._eval_cache_lock:
+            cached = self._eval_cache.get(key)
+            if cached is not None:
+                self._eval_cache.move_to_end(key)
+        if cached is None:
+            score = self._database.lookup_score(key=key)
+            if score is not None:
+                cached = (score, 0.)
+        if cached is not None:
+            future = concurrent.futures.Future()
+            future.set_result(cached)
+            return future
+
+        future = self._submit_evaluation(self._evaluate_fn, str(program) if self._submit_program_str else program)
+        if self._eval_cache_size > 0:
+            future.add_done_callback(lambda f: self._cache_eval_result(key, f))
+        return future
+
+    def _submit_evaluation(self, fn, *args) -> concurrent.futures.Future:
+        self._eval_slots.acquire()
+        try:
+            future = self._evaluation_executor.submit(fn, *args)
+        except:
+            self._eval_slots.release()
+            raise
+        future.add_done_callback(self._release_eval_slot)
+        return future
+
+    def _release_eval_slot(self, future: concurrent.futures.Future):
+        self._eval_slots.release()
+
+    def _cache_eval_result(self, key: bytes, future: concurrent.futures.Future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._eval_cache_lock:
+            self._eval_cache[key] = future.result()
+            self._eval_cache.move_to_end(key)
+            while len(self._eval_cache) > self._eval_cache_size:
+                self._eval_cache.popitem(last=False)
+
+    def _get_prompts(self) -> tuple[list[programs_database.Prompt], list[int]]:
+        """Reserves samples from the budget and gets prompts from the program database.
+        Returns the prompts and the number of samples to be drawn for each prompt. The last prompt gets fewer samples
+        if the rest of the budget is not enough, and there is no prompt if the budget is exhausted.
+        """
+        num_samples = self._reserve_samples(self._batch_prompts * self._samples_per_prompt)
+        samples_per_prompt = [
+            min(self._samples_per_prompt, num_samples - i) for i in range(0, num_samples, self._samples_per_prompt)
+        ]
+        try:
+            prompts = [self._database.get_prompt() for _ in samples_per_prompt]
+        except Exception:
+            self._settle_samples(num_samples, drawn=False)
+            raise
+        return prompts, samples_per_prompt
+
+    def _lookup_prompt_cache(self, prompts: list[programs_database.Prompt], samples_per_prompt: list[int]):
+        """Reuses the samples of near-duplicate prompts if possible.
+        Returns the sampled functions of each prompt (None for the missed prompts),
+        and the indices of the missed prompts, which are to be sampled from the LLM.
+        """
+        sampled_funcs_per_prompt = [None] * len(prompts)
+        if self._prompt_cache is not None:
+            for i, prompt in enumerate(prompts):
+                sampled_funcs_per_prompt[i] = self._prompt_cache.lookup(prompt.code, samples_per_prompt[i])
+        to_be_sampled = [i for i, funcs in enumerate(sampled_funcs_per_prompt) if funcs is None]
+        return sampled_funcs_per_prompt, to_be_sampled
+
+    def _partition_samples(self, prompts, samples_per_prompt, sampled_funcs_per_prompt, to_be_sampled, sampled_funcs):
+        """Partitions the samples drawn by the LLM (ordered by their prompts) by their prompts, and caches them.
+        """
+        start = 0
+        for i in to_be_sampled:
+            sampled_funcs_per_prompt[i] = sampled_funcs[start:start + samples_per_prompt[i]]
+            start += samples_per_prompt[i]
+            if self._prompt_cache is not None:
+                self._prompt_cache.insert(prompts[i].code, sampled_funcs_per_prompt[i])
+
+    def _submit_samples(self, prompts, sampled_funcs_per_prompt, draw_sample_times: float):
+        """Converts the samples to programs, submits them to the evaluation executor,
+        and hands them over to the register thread.
+        """
+        avg_time_for_each_sample = draw_sample_times / sum(len(funcs) for funcs in sampled_funcs_per_prompt)
+
+        # convert samples to program and function instances, and record the island of the prompt
+        programs_to_be_eval = []
+        island_ids = []
+        for prompt, funcs in zip(prompts, sampled_funcs_per_prompt):
+            for func in funcs:
+                program, function = SampleTrimmer.sample_to_program_and_function(func, self._template_program)
+                # if sample to program success
+                if program is not None:
+                    programs_to_be_eval.append((program, function))
+                    island_ids.append(prompt.island_id)
+
+        # submit tasks to the thread pool and evaluate,
+        # identical programs share a single evaluation or reuse the cached result
+        futures = []
+        keys = []
+        batch_futures = {}
+        for program, function in programs_to_be_eval:
+            key = programs_database.canonical_hash(str(function))
+            if key not in batch_futures:
+                batch_futures[key] = self._cached_or_submit(key, program)
+            futures.append(batch_futures[key])
+            keys.append(key)
+        # hand over to the register thread, wait only if too many evaluations are in flight
+        for future, (_, function), key, island_id in zip(futures, programs_to_be_eval, keys, island_ids):
+            with self._in_flight_cond:
+                while len(self._in_flight) >= self._in_flight_capacity and not self._stop.is_set():
+                    self._in_flight_cond.wait()
+                self._in_flight.append((future, function, key, island_id, avg_time_for_each_sample))
+            future.add_done_callback(self._notify_evaluated)
+
     def _sample_evaluate_register(self):
-        while (self._max_sample_nums is None) or (self._tot_sample_nums < self._max_sample_nums):
+        while not self._stop.is_set():
+            num_reserved = 0
             try:
-                # get prompt
-                prompt = self._database.get_prompt()
-                prompt_contents = [prompt.code for _ in range(self._samples_per_prompt)]
+                # get prompts, stop if the budget is exhausted
+                prompts, samples_per_prompt = self._get_prompts()
+                num_reserved = sum(samples_per_prompt)
+                if not prompts:
+                    break
 
-                # do sample
+                # do sample, query the LLM once for all prompts that miss the prompt cache
                 draw_sample_start = time.time()
-                sampled_funcs = self._sampler.draw_samples(prompt_contents)
+                sampled_funcs_per_prompt, to_be_sampled = self._lookup_prompt_cache(prompts, samples_per_prompt)
+                if to_be_sampled:
+                    sampled_funcs = self._sampler.draw_samples_per_prompt(
+                        [prompts[i].code for i in to_be_sampled], [samples_per_prompt[i] for i in to_be_sampled]
+                    )
+                    self._partition_samples(prompts, samples_per_prompt, sampled_funcs_per_prompt, to_be_sampled, sampled_funcs)
                 draw_sample_times = time.time() - draw_sample_start
-                avg_time_for_each_sample = draw_sample_times / len(sampled_funcs)
-
-                # convert samples to program instances
-                programs_to_be_eval = []
-                for func in sampled_funcs:
-                    program = SampleTrimmer.sample_to_program(func, self._template_program)
-                    # if sample to program success
-                    if program is not None:
-                        programs_to_be_eval.append(program)
-
-                # submit tasks to the thread pool and evaluate
-                futures = []
-                for program in programs_to_be_eval:
-                    future = self._evaluation_executor.submit(self._evaluator.evaluate_program_record_time, program)
-                    futures.append(future)
-                # get evaluate scores and evaluate times
-                scores_times = [f.result() for f in futures]
-                scores, times = [i[0] for i in scores_times], [i[1] for i in scores_times]
-
-                # register to program database and profiler
-                island_id = prompt.island_id
-                for program, score, eval_time in zip(programs_to_be_eval, scores, times):
-                    # update
-                    self._tot_sample_nums += 1
-                    # convert to Function instance
-                    function = TextFunctionProgramConverter.program_to_function(program)
-                    # check if the function has converted to Function instance successfully
-                    if function is None:
-                        continue
-                    # register to program database
-                    if score is not None:
-                        self._database.register_function(
-                            function=function,
-                            island_id=island_id,
-                            score=score
-                        )
-                    # register to profiler
-                    if self._profiler is not None:
-                        function.score = score
-                        function.sample_time = avg_time_for_each_sample
-                        function.evaluate_time = eval_time
-                        self._profiler.register_function(function)
-                        if isinstance(self._profiler, FunSearchProfiler):
-                            self._profiler.register_program_db(self._database)
-            except KeyboardInterrupt:
-                break
+                # the samples are drawn, so that the reservation is consumed even if they fail later
+                self._settle_samples(num_reserved, drawn=True)
+                num_reserved = 0
+
+                # evaluate and register
+                self._submit_samples(prompts, sampled_funcs_per_prompt, draw_sample_times)
             except Exception as e:
+                # give back the reservation of the samples that were not drawn
+                self._settle_samples(num_reserved, drawn=False)
                 if self._debug_mode:
                     traceback.print_exc()
                     exit()
                 continue
 
-        # shutdown evaluation_executor
+    async def _sample_evaluate_register_async(self):
+        while not self._stop.is_set():
+            num_reserved = 0
+            try:
+                # get prompts, stop if the budget is exhausted
+                prompts, samples_per_prompt = self._get_prompts()
+                num_reserved = sum(samples_per_prompt)
+                if not prompts:
+                    break
+
+                # do sample, other samplers run in the event loop while waiting for the LLM
+                draw_sample_start = time.time()
+                sampled_funcs_per_prompt, to_be_sampled = self._lookup_prompt_cache(prompts, samples_per_prompt)
+                if to_be_sampled:
+                    sampled_funcs = await self._sampler.draw_samples_per_prompt_async(
+                        [prompts[i].code for i in to_be_sampled], [samples_per_prompt[i] for i in to_be_sampled]
+                    )
+                    self._partition_samples(prompts, samples_per_prompt, sampled_funcs_per_prompt, to_be_sampled, sampled_funcs)
+                draw_sample_times = time.time() - draw_sample_start
+                # the samples are drawn, so that the reservation is consumed even if they fail later
+                self._settle_samples(num_reserved, drawn=True)
+                num_reserved = 0
+
+                # evaluate and register, the samples are converted to programs out of the event loop
+                await asyncio.to_thread(self._submit_samples, prompts, sampled_funcs_per_prompt, draw_sample_times)
+            except Exception as e:
+                # give back the reservation of the samples that were not drawn
+                self._settle_samples(num_reserved, drawn=False)
+                if self._debug_mode:
+                    traceback.print_exc()
+                    exit()
+                continue
+
+    def _run_async_samplers(self):
+        async def run_samplers():
+            # each sampler runs at most one blocking call in a thread at a time (submitting samples,
+            # or querying an LLM without an async client), the default executor is too small for a large 'num_samplers'
+            asyncio.get_running_loop().set_default_executor(
+                concurrent.futures.ThreadPoolExecutor(max_workers=self._num_samplers)
+            )
+            await asyncio.gather(*(self._sample_evaluate_register_async() for _ in range(self._num_samplers)))
+
+        asyncio.run(run_samplers())
+
+    def _reserve_samples(self, num_samples: int) -> int:
+        """Reserves at most num_samples samples from the budget 'max_sample_nums'.
+        Returns the number of reserved samples, which is 0 if the budget is exhausted or the run is interrupted.
+        The run is stopped once the budget is exhausted and no reserved sample may be given back,
+        the other samplers that see an exhausted budget before then just exit.
+        """
+        with self._tot_sample_nums_lock:
+            if self._stop.is_set():
+                return 0
+            if self._max_sample_nums is not None:
+                num_samples = min(num_samples, self._max_sample_nums - self._tot_sample_nums)
+            if num_samples <= 0:
+                if self._num_undrawn_samples == 0:
+                    self._stop.set()
+                return 0
+            self._tot_sample_nums += num_samples
+            self._num_undrawn_samples += num_samples
+            return num_samples
+
+    def _settle_samples(self, num_samples: int, drawn: bool):
+        """Settles num_samples reserved samples, which are given back to the budget if they are not drawn.
+        """
+        if num_samples <= 0:
+            return
+        with self._tot_sample_nums_lock:
+            self._num_undrawn_samples -= num_samples
+            if not drawn:
+                self._tot_sample_nums -= num_samples
+
+    def _notify_evaluated(self, future: concurrent.futures.Future):
+        with self._in_flight_cond:
+            self._in_flight_cond.notify_all()
+
+    def _register_evaluated_programs(self):
+        while True:
+            # wait until any evaluation in flight finishes, no matter its submission order
+            with self._in_flight_cond:
+                while not any(entry[0].done() for entry in self._in_flight):
+                    if not self._in_flight and self._sampling_finished:
+                        return
+                    self._in_flight_cond.wait()
+                batch = [entry for entry in self._in_flight if entry[0].done()]
+                self._in_flight = deque(entry for entry in self._in_flight if not entry[0].done())
+                self._in_flight_cond.notify_all()
+            # any exception is swallowed here, as the samplers would wait forever if this thread ends early
+            for future, function, key, island_id, sample_time in batch:
+                try:
+                    score, eval_time = future.result()
+                    self._register_function(function, key, island_id, score, eval_time, sample_time)
+                except Exception as e:
+                    if self._debug_mode:
+                        traceback.print_exc()
+            # snapshot the program database once per batch
+            try:
+                if isinstance(self._profiler, FunSearchProfiler):
+                    self._profiler.register_program_db(self._database)
+            except Exception as e:
+                if self._debug_mode:
+                    traceback.print_exc()
+
+    def _register_function(self, function: Function, key: bytes, island_id: int, score, eval_time: float, sample_time: float):
+        # register to program database
+        if score is not None:
+            self._database.register_function(
+                function=function,
+                island_id=island_id,
+                score=score,
+                key=key
+            )
+        # register to profiler
+        if self._profiler is not None:
+            function.score = score
+            function.sample_time = sample_time
+            function.evaluate_time = eval_time
+            self._profiler.register_function(function)
+
+    def _finish_sampling(self):
+        with self._in_flight_cond:
+            self._sampling_finished = True
+            self._in_flight_cond.notify_all()
+
+    def _shutdown_evaluation_executor(self, wait=True):
         try:
-            self._evaluation_executor.shutdown(cancel_futures=True)
+            self._evaluation_executor.shutdown(wait=wait, cancel_futures=True)
         except:
             pass
 
@@ -203,13 +493,31 @@ class FunSearch:
                 self._function_to_evolve.evaluate_time = eval_time
                 self._profiler.register_function(self._function_to_evolve)
 
-        # start sampling using multiple threads
+        # start sampling using multiple threads, and registering using a single thread
+        self._register_thread.start()
         for t in self._sampler_threads:
             t.start()
 
-        # join all threads to the main thread
-        for t in self._sampler_threads:
-            t.join()
+        # join all threads to the main thread, joining with a timeout keeps the main thread responsive to KeyboardInterrupt
+        try:
+            for t in self._sampler_threads:
+                while t.is_alive():
+                    t.join(timeout=1)
+        except KeyboardInterrupt:
+            # stop sampling, drop the pending evaluations, and let the threads exit in the background
+            self._stop.set()
+            self._finish_sampling()
+            self._shutdown_evaluation_executor(wait=False)
+            raise
+        self._finish_sampling()
+        self._register_thread.join()
+        self._shutdown_evaluation_executor()
 
         if self._profiler is not None:
+            try:
+                if isinstance(self._profiler, FunSearchProfiler):
+                    self._profiler.register_program_db(self._database, force=True)
+            except Exception as e:
+                if self._debug_mode:
+                    traceback.print_exc()
             self._profiler.finish()
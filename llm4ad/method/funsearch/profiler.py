@@ -44,19 +44,26 @@ class FunSearchProfiler(ProfilerBase):
             os.makedirs(self._prog_db_path, exist_ok=True)
         self._intv = program_db_register_interval
         self._db_lock = Lock()
+        self._db_registered_num_samples = initial_num_samples
 
-    def register_program_db(self, program_db: ProgramsDatabase):
-        """Save ProgramDB to a file.
+    def register_program_db(self, program_db: ProgramsDatabase, *, force=False):
+        """Save ProgramDB to a file once every `program_db_register_interval` samples.
+        This can be invoked once per batch of samples, as the number of samples does not need to hit a multiple of the interval.
+        If `force` is True, save ProgramDB as long as any sample has been registered since the last save.
         [
             [{'score': -300, 'functions': [xxx, xxx, xxx, ...]}, {'score': -200, 'functions': [xxx, xxx, xxx, ...]}, {...}],
             [{...}, {...}],
         ]
         """
         try:
-            if (self.__class__._num_samples == 0 or
-                    self.__class__._num_samples % self._intv != 0):
+            num_samples = self.__class__._num_samples
+            if force:
+                if num_samples == self._db_registered_num_samples:
+                    return
+            elif num_samples // self._intv <= self._db_registered_num_samples // self._intv:
                 return
             self._db_lock.acquire()
+            self._db_registered_num_samples = num_samples
             self.__class__._prog_db_order += 1
             isld_list = []
             for island in program_db.islands:
@@ -102,6 +109,7 @@ class FunSearchTensorboardProfiler(TensorboardProfiler, FunSearchProfiler):
             evaluation_name=evaluation_name,
             method_name=method_name,
             program_db_register_interval=program_db_register_interval,
+            initial_num_samples=initial_num_samples,
             log_style=log_style,
             create_random_path=create_random_path,
             **kwargs
@@ -16,8 +16,10 @@
 """A programs database that implements the evolutionary algorithm."""
 from __future__ import annotations
 
+import ast
 import copy
 import dataclasses
+import hashlib
 import time
 from collections.abc import Sequence
 from typing import Any
@@ -49,6 +51,60 @@ def _softmax(logits: np.ndarray, temperature: float) -> np.ndarray:
         raise type_err
 
 
+class _CanonicalTransformer(ast.NodeTransformer):
+    """Strips docstrings and type annotations, which do not change the behavior of the code."""
+
+    @staticmethod
+    def _strip_docstring(node):
+        body = node.body
+        if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) \
+                and isinstance(body[0].value.value, str):
+            node.body = body[1:] or [ast.Pass()]
+        return node
+
+    def visit_Module(self, node: ast.Module):
+        self.generic_visit(node)
+        return self._strip_docstring(node)
+
+    def visit_ClassDef(self, node: ast.ClassDef):
+        self.generic_visit(node)
+        return self._strip_docstring(node)
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        self.generic_visit(node)
+        node.returns = None
+        return self._strip_docstring(node)
+
+    def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef):
+        self.generic_visit(node)
+        node.returns = None
+        return self._strip_docstring(node)
+
+    def visit_arg(self, node: ast.arg):
+        node.annotation = None
+        return node
+
+    def visit_AnnAssign(self, node: ast.AnnAssign):
+        self.generic_visit(node)
+        if node.value is None:
+            # a bare annotation still makes the name local to its scope, so keep it without the type
+            node.annotation = ast.Constant(None)
+            return node
+        return ast.Assign(targets=[node.target], value=node.value, lineno=node.lineno)
+
+
+def canonical_hash(code: str) -> bytes:
+    """Returns the hash of the code, which is insensitive to
+    comments, formatting, docstrings, and type annotations.
+    """
+    try:
+        tree = _CanonicalTransformer().visit(ast.parse(code))
+        code = ast.unparse(tree)
+    except SyntaxError:
+        pass
+    return hashlib.blake2b(code.encode(), digest_size=16).digest()
+
+
 @dataclasses.dataclass(frozen=True)
 class Prompt:
     """A prompt produced by the ProgramsDatabase, to be sent to Samplers.
@@ -89,6 +145,8 @@ class ProgramsDatabase:
         self._best_program_per_island: list[Function | None] = ([None] * config.num_islands)
         self._best_scores_per_test_per_island: list[Any | None] = ([None] * config.num_islands)
         self._last_reset_time: float = time.time()
+        # canonical hash of each registered function => its score
+        self._canonical_scores: dict[bytes, Any] = {}
 
     def get_prompt(self) -> Prompt:
         """Returns a prompt containing implementations from one chosen island."""
@@ -100,6 +158,15 @@ class ProgramsDatabase:
     def islands(self):
         return self._islands
 
+    def lookup_score(self, function: Function | None = None, *, key: bytes | None = None) -> Any | None:
+        """Returns the score of a registered function that is structurally identical to
+        `function` (see `canonical_hash`), or None if there is no such function.
+        Pass the canonical hash of the function as `key` if it is already computed.
+        """
+        if key is None:
+            key = canonical_hash(str(function))
+        return self._canonical_scores.get(key)
+
     def _register_function_in_island(
             self,
             function: Function,
@@ -118,11 +185,18 @@ class ProgramsDatabase:
             function: Function,
             island_id: int | None,
             score: Any,
+            *,
+            key: bytes | None = None,
     ) -> None:
-        """Registers `program` in the database."""
+        """Registers `program` in the database.
+        Pass the canonical hash of the function as `key` if it is already computed.
+        """
         # In an asynchronous funsearch_impl we should consider the possibility of
         # registering a program on an island that had been reset after the prompt
         # was generated. Leaving that out here for simplicity.
+        if key is None:
+            key = canonical_hash(str(function))
+        self._canonical_scores[key] = score
         if island_id is None:
             # This is a program added at the beginning, so adding it to all islands.
             for island_id in range(len(self._islands)):
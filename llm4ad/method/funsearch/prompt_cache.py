@@ -0,0 +1,102 @@
+"""A semantic cache that reuses the samples of near-duplicate prompts."""
+from __future__ import annotations
+
+import hashlib
+import random
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_TOKEN_PATTERN = re.compile(r'[A-Za-z_]\w*|\d+|\S')
+
+
+class SemanticPromptCache:
+    """Caches the sampled functions of prompts, and returns them for the later prompts
+    whose Jaccard similarity (estimated by MinHash over token shingles) exceeds a threshold.
+    """
+
+    def __init__(
+            self,
+            threshold: float = 0.9,
+            *,
+            num_perm: int = 64,
+            shingle_size: int = 3,
+            capacity: int = 256,
+            ttl_seconds: float | None = 600,
+            seed: int = 2024,
+    ):
+        """
+        Args:
+            threshold   : the minimal estimated Jaccard similarity between two prompts to be treated as a hit.
+            num_perm    : the number of permutations of the MinHash signature.
+            shingle_size: the number of consecutive tokens in a shingle.
+            capacity    : the maximum number of cached prompts, the least recently used one is evicted first.
+            ttl_seconds : cached prompts expire after ttl_seconds, so that the drift of islands is respected.
+                If set to None, cached prompts never expire.
+            seed        : the random seed of the MinHash permutations.
+        """
+        assert 0 < threshold <= 1
+        self._threshold = threshold
+        self._shingle_size = shingle_size
+        self._capacity = capacity
+        self._ttl_seconds = ttl_seconds
+        rng = np.random.default_rng(seed)
+        self._perm_a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._perm_b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+        # entry id => (signature, sampled functions, insert time)
+        self._entries: OrderedDict[int, tuple[np.ndarray, list[str], float]] = OrderedDict()
+        self._next_id = 0
+        self._lock = Lock()
+
+    def _signature(self, prompt: str) -> np.ndarray:
+        tokens = _TOKEN_PATTERN.findall(prompt)
+        k = self._shingle_size
+        shingles = {' '.join(tokens[i:i + k]) for i in range(max(len(tokens) - k + 1, 1))}
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), 'little') for s in shingles],
+            dtype=np.uint64
+        )
+        # (a * h + b) mod p for each permutation (rows) and shingle (columns), a, b < 2^31 and h < 2^32
+        permuted = (np.outer(self._perm_a, hashes) + self._perm_b[:, None]) % np.uint64(_MERSENNE_PRIME)
+        return permuted.min(axis=1)
+
+    def _evict_expired(self, now: float):
+        if self._ttl_seconds is None:
+            return
+        expired = [i for i, (_, _, t) in self._entries.items() if now - t > self._ttl_seconds]
+        for i in expired:
+            del self._entries[i]
+
+    def lookup(self, prompt: str, num_samples: int) -> list[str] | None:
+        """Returns at most num_samples cached functions of the most similar prompt,
+        or None if no cached prompt is similar enough.
+        """
+        signature = self._signature(prompt)
+        with self._lock:
+            self._evict_expired(time.time())
+            best_id, best_sim = None, self._threshold
+            for i, (sig, _, _) in self._entries.items():
+                sim = float(np.mean(sig == signature))
+                if sim >= best_sim:
+                    best_id, best_sim = i, sim
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            samples = self._entries[best_id][1]
+            return random.sample(samples, min(num_samples, len(samples)))
+
+    def insert(self, prompt: str, sampled_funcs: list[str]):
+        """Caches the sampled functions of the prompt.
+        """
+        if not sampled_funcs:
+            return
+        signature = self._signature(prompt)
+        with self._lock:
+            self._entries[self._next_id] = (signature, list(sampled_funcs), time.time())
+            self._next_id += 1
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
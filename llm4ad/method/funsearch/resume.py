@@ -120,6 +120,8 @@ def resume_funsearch(fs: FunSearch):
     fs._database = db
     # resume profiler
     _resume_pf(log_path, pf, template_func)
-    # resume funsearch
+    # resume funsearch, note that '_tot_sample_nums' counts the drawn samples, while the sample order only counts
+    # the registered ones. The drawn samples that failed to be converted to programs, or were still in flight
+    # when the last run stopped, are not logged, so the resumed run may draw slightly more than 'max_sample_nums'
     _, _, sample_max_order = _get_all_samples_and_scores(log_path)
     fs._tot_sample_nums = sample_max_order
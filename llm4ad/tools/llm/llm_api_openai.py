@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import asyncio
+
 import openai
-from typing import Any
+from typing import Any, List
 
 from llm4ad.base import LLM
 
@@ -11,6 +13,8 @@ class OpenAIAPI(LLM):
         super().__init__()
         self._model = model
         self._client = openai.OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, **kwargs)
+        # used by the async methods, so that many requests are in flight without a thread for each of them
+        self._async_client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout, **kwargs)
 
     def draw_sample(self, prompt: str | Any, *args, **kwargs) -> str:
         response = self._client.chat.completions.create(
@@ -19,3 +23,63 @@ class OpenAIAPI(LLM):
             stream=False,
         )
         return response.choices[0].message.content
+
+    def draw_samples_per_prompt(self, prompts: List[str | Any], n: int | List[int] = 1, *args, **kwargs) -> List[str]:
+        if isinstance(n, int):
+            n = [n] * len(prompts)
+        ret = []
+        for prompt, num in zip(prompts, n):
+            # request all completions of the prompt at once, and top up if the server ignores 'n'
+            try:
+                response = self._client.chat.completions.create(
+                    model=self._model,
+                    messages=prompt,
+                    stream=False,
+                    n=num,
+                )
+            except openai.BadRequestError:
+                # the server may reject 'n' > 1, request the completions one by one,
+                # other errors (rate limits, timeouts, ...) are raised as is
+                ret += super().draw_samples_per_prompt([prompt], num, *args, **kwargs)
+                continue
+            contents = [choice.message.content for choice in response.choices[:num]]
+            contents += [self.draw_sample(prompt, *args, **kwargs) for _ in range(num - len(contents))]
+            ret += contents
+        return ret
+
+    async def draw_sample_async(self, prompt: str | Any, *args, **kwargs) -> str:
+        response = await self._async_client.chat.completions.create(
+            model=self._model,
+            messages=prompt,
+            stream=False,
+        )
+        return response.choices[0].message.content
+
+    async def draw_samples_async(self, prompts: List[str | Any], *args, **kwargs) -> List[str]:
+        return list(await asyncio.gather(*(self.draw_sample_async(p, *args, **kwargs) for p in prompts)))
+
+    async def draw_samples_per_prompt_async(self, prompts: List[str | Any], n: int | List[int] = 1, *args, **kwargs) -> List[str]:
+        if isinstance(n, int):
+            n = [n] * len(prompts)
+
+        async def draw(prompt, num):
+            # request all completions of the prompt at once, and top up if the server ignores 'n'
+            try:
+                response = await self._async_client.chat.completions.create(
+                    model=self._model,
+                    messages=prompt,
+                    stream=False,
+                    n=num,
+                )
+            except openai.BadRequestError:
+                # the server may reject 'n' > 1, request the completions concurrently one by one,
+                # other errors (rate limits, timeouts, ...) are raised as is
+                return await self.draw_samples_async([prompt] * num, *args, **kwargs)
+            contents = [choice.message.content for choice in response.choices[:num]]
+            contents += await self.draw_samples_async([prompt] * (num - len(contents)), *args, **kwargs)
+            return contents
+
+        ret = []
+        for contents in await asyncio.gather(*(draw(p, num) for p, num in zip(prompts, n))):
+            ret += contents
+        return ret